@@ -2,6 +2,9 @@
 # copyright notices and license terms.
 from trytond.pool import Pool
 from . import configuration
+from . import invoice
+from . import invoice_profile
+from . import timesheet
 from . import work
 
 
@@ -10,4 +13,9 @@ def register():
         configuration.Configuration,
         work.Work,
         work.WorkInvoicedProgress,
+        invoice_profile.WorkInvoiceProfile,
+        invoice_profile.WorkInvoiceProfileStage,
+        invoice.Invoice,
+        invoice.InvoiceLine,
+        timesheet.TimesheetLine,
         module='project_product', type_='model')
@@ -22,3 +22,5 @@ class Configuration:
         ], states={
             'invisible': Eval('invoice_product_type') == 'service',
         }, depends=['invoice_product_type']))
+    invoice_profile = fields.Property(fields.Boolean('Profile Invoicing',
+            help='Record the timings of each invoicing run.'))
@@ -0,0 +1,46 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+from .invoice_profile import get_invoice_profiler, profile_invoice_stage
+
+__all__ = ['Invoice', 'InvoiceLine']
+
+
+class Invoice:
+    __name__ = 'account.invoice'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def create(cls, vlist):
+        if not get_invoice_profiler():
+            return super(Invoice, cls).create(vlist)
+        with profile_invoice_stage('save') as count:
+            invoices = super(Invoice, cls).create(vlist)
+            count(len(invoices))
+        return invoices
+
+    @classmethod
+    def update_taxes(cls, invoices, exception=False):
+        if not get_invoice_profiler():
+            return super(Invoice, cls).update_taxes(invoices,
+                exception=exception)
+        with profile_invoice_stage('taxes') as count:
+            result = super(Invoice, cls).update_taxes(invoices,
+                exception=exception)
+            count(len(invoices))
+        return result
+
+
+class InvoiceLine:
+    __name__ = 'account.invoice.line'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def create(cls, vlist):
+        if not get_invoice_profiler():
+            return super(InvoiceLine, cls).create(vlist)
+        with profile_invoice_stage('save') as count:
+            lines = super(InvoiceLine, cls).create(vlist)
+            count(len(lines))
+        return lines
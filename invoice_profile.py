@@ -0,0 +1,143 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.transaction import Transaction
+
+__all__ = ['WorkInvoiceProfile', 'WorkInvoiceProfileStage']
+
+PROFILE_STAGES = [
+    ('lines', 'Line Collection'),
+    ('grouping', 'Grouping'),
+    ('invoice_line', 'Line Construction'),
+    ('taxes', 'Tax Resolution'),
+    ('save', 'Save'),
+    ]
+
+
+class WorkInvoiceProfile(ModelSQL, ModelView):
+    'Work Invoice Profile'
+    __name__ = 'project.work.invoice_profile'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True)
+    date = fields.DateTime('Date', readonly=True)
+    works = fields.Integer('Works', readonly=True)
+    duration = fields.Float('Duration', digits=(16, 6), readonly=True,
+        help='Total seconds spent invoicing.')
+    stages = fields.One2Many('project.work.invoice_profile.stage', 'profile',
+        'Stages', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(WorkInvoiceProfile, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+
+class WorkInvoiceProfileStage(ModelSQL, ModelView):
+    'Work Invoice Profile Stage'
+    __name__ = 'project.work.invoice_profile.stage'
+    profile = fields.Many2One('project.work.invoice_profile', 'Profile',
+        required=True, select=True, ondelete='CASCADE')
+    stage = fields.Selection(PROFILE_STAGES, 'Stage', required=True,
+        readonly=True)
+    duration = fields.Float('Duration', digits=(16, 6), readonly=True,
+        help='Seconds spent on the stage.')
+    count = fields.Integer('Count', readonly=True,
+        help='Number of rows handled by the stage.')
+
+
+class InvoiceProfiler(object):
+    """
+    Collects the timings and row counts of the invoicing stages
+
+    Nested calls to the same stage (for example goods timesheet lines that
+    fall back to progress lines) are only measured once. Stages of different
+    kind may overlap: goods line tax rules are resolved while the line is
+    constructed. Service lines resolve their tax rules inside project_invoice
+    line construction, so the tax stage only covers goods line tax rules and
+    the invoice taxes update.
+    """
+
+    def __init__(self):
+        stages = [s for s, _ in PROFILE_STAGES]
+        self.durations = dict.fromkeys(stages, 0.0)
+        self.counts = dict.fromkeys(stages, 0)
+        self.depths = dict.fromkeys(stages, 0)
+        self.duration = 0.0
+        self.group_key = None
+
+    @contextmanager
+    def stage(self, name):
+        "Measure the block as the stage and yield a function to count rows"
+        nested = self.depths[name]
+        self.depths[name] += 1
+        start = time.time()
+
+        def count(rows):
+            if not nested:
+                self.counts[name] += rows
+        try:
+            yield count
+        finally:
+            self.depths[name] -= 1
+            if not nested:
+                self.durations[name] += time.time() - start
+
+    def add_group_key(self, key):
+        "Count a new group each time the grouping key changes"
+        if key != self.group_key:
+            self.counts['grouping'] += 1
+        self.group_key = key
+
+    def get_profile_values(self, company, works):
+        return {
+            'company': company.id,
+            'date': datetime.datetime.now(),
+            'works': len(works),
+            'duration': self.duration,
+            'stages': [('create', [{
+                            'stage': stage,
+                            'duration': self.durations[stage],
+                            'count': self.counts[stage],
+                            } for stage, _ in PROFILE_STAGES])],
+            }
+
+
+def get_invoice_profiler():
+    "Return the invoice profiler of the context if profiling is enabled"
+    return Transaction().context.get('_invoice_profiler')
+
+
+@contextmanager
+def profile_invoice_stage(stage):
+    """
+    Measure the block as the invoicing stage when profiling is enabled
+
+    It yields a function that receives the number of rows handled.
+    """
+    profiler = get_invoice_profiler()
+    if not profiler:
+        yield lambda rows: None
+        return
+    with profiler.stage(stage) as count:
+        yield count
+
+
+def profile_invoice_call(stage):
+    "Measure each call of the decorated method as one row of the stage"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_invoice_stage(stage) as count:
+                count(1)
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,17 +1,210 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+import gc
 import unittest
 import doctest
+import weakref
+from decimal import Decimal
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.tests.test_tryton import DB_NAME, USER
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.project_product.work import iter_chunks
+
+TOTAL_NAMES = ['progress_amount', 'invoiced_amount', 'timesheet_duration',
+    'total_effort']
+
+
+def create_works(company, count):
+    "Create count tasks alternating service and goods works"
+    pool = Pool()
+    Work = pool.get('project.work')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': 'Good',
+                'type': 'goods',
+                'default_uom': unit.id,
+                'list_price': Decimal(10),
+                'cost_price': Decimal(5),
+                }])
+    product, = Product.create([{
+                'template': template.id,
+                }])
+    return Work.create([{
+                'name': 'Work %s' % i,
+                'type': 'task',
+                'company': company.id,
+                'project_invoice_method': 'timesheet',
+                'invoice_product_type': 'goods' if i % 2 else 'service',
+                'product_goods': product.id if i % 2 else None,
+                'uom': unit.id if i % 2 else None,
+                'quantity': 4.0,
+                'progress_quantity': float(i % 4),
+                'list_price': Decimal(10),
+                'effort_duration': datetime.timedelta(hours=i),
+                } for i in range(count)])
 
 
 class ProjectProductTestCase(ModuleTestCase):
     'Test module'
     module = 'project_product'
 
+    @with_transaction()
+    def test_work_chunks(self):
+        'Test work metrics computed by chunks'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        company = create_company()
+        with set_company(company):
+            works = create_works(company, 7)
+            works = Work.browse([w.id for w in works])
+
+            expected = Work.get_total(works, TOTAL_NAMES)
+            self.assertEqual(expected['progress_amount'][works[1].id],
+                Decimal('10.0000'))
+
+            values = dict(Work.iter_total(iter(works), TOTAL_NAMES, size=2))
+            self.assertEqual(sorted(values), sorted(w.id for w in works))
+            for name in TOTAL_NAMES:
+                self.assertEqual(
+                    dict((i, v[name]) for i, v in values.iteritems()),
+                    expected[name])
+
+            # Records of a chunk are released once the next chunk is read
+            chunks = iter_chunks(iter(works), size=3)
+            chunk = next(chunks)
+            self.assertEqual(len(chunk), 3)
+            self.assertEqual(chunk[0].invoice_product_type, 'service')
+            refs = map(weakref.ref, chunk)
+            del chunk
+            chunk = next(chunks)
+            gc.collect()
+            self.assertEqual([r() for r in refs], [None] * 3)
+            self.assertEqual([w.id for w in chunk],
+                [w.id for w in works[3:6]])
+
+    @with_transaction()
+    def test_iter_total_memory(self):
+        'Test iter_total memory stays flat as the number of works grows'
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        def peak_growth(ids, size=50):
+            "Return the peak growth of live objects while iterating"
+            works = (Work(i) for i in ids)
+            gc.collect()
+            baseline = len(gc.get_objects())
+            peak = 0
+            for i, _ in enumerate(Work.iter_total(works, TOTAL_NAMES,
+                        size=size)):
+                if not i % size:
+                    peak = max(peak, len(gc.get_objects()) - baseline)
+            return peak
+
+        company = create_company()
+        with set_company(company):
+            small = [w.id for w in create_works(company, 200)]
+            large = [w.id for w in create_works(company, 2000)]
+            # Warm up the caches that do not depend on the number of works
+            peak_growth(small)
+            small_peak = peak_growth(small)
+            large_peak = peak_growth(large)
+        # Holding every work would grow ten times with ten times more works
+        self.assertGreater(small_peak, 0)
+        self.assertLess(large_peak, 2 * small_peak)
+
+    @with_transaction()
+    def test_goods_metrics(self):
+        'Test goods metrics computed by company'
+        pool = Pool()
+        Work = pool.get('project.work')
+        transaction = Transaction()
+
+        self.assertEqual(Work.get_goods_metrics([]), {
+                'invoiced_amount': {},
+                'progress_amount': {},
+                'pending_quantity': {},
+                })
+
+        company1 = create_company()
+        company2 = create_company('Michael Scott Paper Company',
+            company1.currency)
+        with set_company(company1):
+            works = Work.create([{
+                        'name': 'Work %s' % i,
+                        'type': 'task',
+                        'company': company.id,
+                        } for i, company in enumerate(
+                        [company1, company2, company1])])
+        self.assertRaises(UserError, Work.get_goods_metrics, works)
+        # Grouping and merge only, the worker path is tested below
+
+        calls = []
+
+        def get_company_goods_metrics(database_name, user, context, ids,
+                names):
+            calls.append((context['company'], sorted(ids)))
+            return [dict([('id', i)] + [(n, context['company'])
+                            for n in names]) for i in ids]
+
+        # Pretend the works are committed and skip the worker transactions
+        transaction.counter = 0
+        Work._get_company_goods_metrics = staticmethod(
+            get_company_goods_metrics)
+        try:
+            result = Work.get_goods_metrics(works, ['progress_amount'],
+                workers=2)
+        finally:
+            del Work._get_company_goods_metrics
+        self.assertEqual(sorted(calls), sorted([
+                    (company1.id, sorted([works[0].id, works[2].id])),
+                    (company2.id, [works[1].id]),
+                    ]))
+        self.assertEqual(result, {
+                'progress_amount': {
+                    works[0].id: company1.id,
+                    works[1].id: company2.id,
+                    works[2].id: company1.id,
+                    },
+                })
+
+    @unittest.skipIf(DB_NAME != ':memory:',
+        'only in-memory sqlite shares uncommitted data with a new transaction')
+    @with_transaction()
+    def test_company_goods_metrics(self):
+        'Test goods metrics read in a worker transaction'
+        pool = Pool()
+        Work = pool.get('project.work')
+        names = ['progress_amount', 'invoiced_amount', 'pending_quantity']
+
+        company = create_company()
+        with set_company(company):
+            works = create_works(company, 4)
+            ids = [w.id for w in works]
+            expected = Work.get_total(works, names[:2])
+        expected['pending_quantity'] = dict(zip(ids, [0.0, 1.0, 0.0, 3.0]))
+
+        # The worker transaction rolls back the shared connection on exit,
+        # so it must be the last use of the data of this test
+        values = Work._get_company_goods_metrics(DB_NAME, USER,
+            {'company': company.id}, ids, names)
+        self.assertEqual(sorted(v['id'] for v in values), sorted(ids))
+        for name in names:
+            self.assertEqual(dict((v['id'], v[name]) for v in values),
+                expected[name])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -43,4 +236,9 @@ def suite():
             setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
             checker=doctest_checker,
             optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
+    suite.addTests(doctest.DocFileSuite(
+            'scenario_project_product_invoice_profile.rst',
+            setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
+            checker=doctest_checker,
+            optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
     return suite
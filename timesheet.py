@@ -0,0 +1,22 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+from .invoice_profile import get_invoice_profiler, profile_invoice_stage
+
+__all__ = ['TimesheetLine']
+
+
+class TimesheetLine:
+    __name__ = 'timesheet.line'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    def write(cls, *args):
+        if not get_invoice_profiler():
+            return super(TimesheetLine, cls).write(*args)
+        actions = iter(args)
+        rows = sum(len(lines) for lines, _ in zip(actions, actions))
+        with profile_invoice_stage('save') as count:
+            super(TimesheetLine, cls).write(*args)
+            count(rows)
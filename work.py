@@ -1,14 +1,24 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 import datetime
+import time
+from collections import defaultdict
 from decimal import Decimal
+from itertools import groupby, islice
+from multiprocessing.pool import ThreadPool
 
-from trytond.model import fields
+from trytond.config import config
+from trytond.model import ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
 from trytond.modules.product import price_digits
 
+from .invoice_profile import (InvoiceProfiler, get_invoice_profiler,
+    profile_invoice_stage, profile_invoice_call)
+
 __all__ = ['Work', 'WorkInvoicedProgress', 'get_service_goods_aux']
 
 STATES = {
@@ -41,6 +51,42 @@ class WorkInvoicedProgress:
             return self.work.uom.digits
         return 2
 
+    @classmethod
+    def create(cls, vlist):
+        if not get_invoice_profiler():
+            return super(WorkInvoicedProgress, cls).create(vlist)
+        with profile_invoice_stage('save') as count:
+            progresses = super(WorkInvoicedProgress, cls).create(vlist)
+            count(len(progresses))
+        return progresses
+
+    @classmethod
+    def write(cls, *args):
+        if not get_invoice_profiler():
+            return super(WorkInvoicedProgress, cls).write(*args)
+        actions = iter(args)
+        rows = sum(len(progresses) for progresses, _ in zip(actions, actions))
+        with profile_invoice_stage('save') as count:
+            super(WorkInvoicedProgress, cls).write(*args)
+            count(rows)
+
+
+def iter_chunks(records, size=None):
+    """
+    Yield lists of at most size records from any iterable
+
+    Each chunk is browsed again, so its records only prefetch and cache the
+    chunk and are released once the next chunk is read.
+    """
+    if size is None:
+        size = Transaction().database.IN_MAX
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk[0].__class__.browse([r.id for r in chunk])
+
 
 def get_service_goods_aux(works, service_computation, goods_computation):
     """
@@ -120,6 +166,9 @@ class Work:
     invoiced_quantity = fields.Function(fields.Float('Invoiced Quantity',
             digits=(16, Eval('uom_digits', 2)), depends=['uom_digits']),
         'get_invoiced_quantity')
+    pending_quantity = fields.Function(fields.Float('Pending Quantity',
+            digits=(16, Eval('uom_digits', 2)), depends=['uom_digits']),
+        'get_pending_quantity')
 
     @classmethod
     def __setup__(cls):
@@ -140,6 +189,11 @@ class Work:
                 field_depends.append('invoice_product_type')
         if 'invoice' in cls._buttons:
             cls._buttons['invoice']['readonly'] = False
+        cls._error_messages.update({
+                'goods_metrics_pending_writes': ('Goods metrics can not be '
+                    'computed in a transaction that has written records, '
+                    'even if they are committed.'),
+                })
 
     @classmethod
     def view_attributes(cls):
@@ -213,6 +267,12 @@ class Work:
         invoiced_quantity.quantize(Decimal(str(10.0 ** - self.uom_digits)))
         return float(invoiced_quantity)
 
+    def get_pending_quantity(self, name):
+        if (self.invoice_product_type != 'goods'
+                or self.progress_quantity is None):
+            return 0.0
+        return self.progress_quantity - self.invoiced_quantity
+
     @classmethod
     def get_total(cls, works, names):
         # Explanation what it does in project, project_invoice, project_revenue
@@ -269,6 +329,86 @@ class Work:
                 del result[key]
         return result
 
+    @classmethod
+    def iter_total(cls, works, names, size=None):
+        """
+        Yield (work id, {name: value}) for the get_total field names
+
+        works can be any iterable, it is computed in chunks of size works so
+        batch recomputations and exports do not hold every work in memory.
+        """
+        for chunk in iter_chunks(works, size):
+            result = cls.get_total(chunk, names)
+            for work in chunk:
+                yield work.id, dict((n, result[n][work.id]) for n in names)
+
+    @classmethod
+    def get_goods_metrics(cls, works, names=None, workers=None):
+        """
+        Return a dictionary {name: {work id: value}} for the field names
+
+        Works are grouped by company and each company is read in a thread
+        with its own read-only transaction and the company in the context.
+        Threads share the GIL, so only the database queries overlap: the
+        getters do not run on several cores and the default number of
+        workers (metrics_workers in the project_product section) is small.
+
+        Worker transactions only see committed data. The transaction write
+        counter is not reset by commit, so it fails if the current
+        transaction has written anything: call it from a fresh transaction.
+        """
+        transaction = Transaction()
+        if transaction.counter:
+            cls.raise_user_error('goods_metrics_pending_writes')
+        if names is None:
+            names = ['invoiced_amount', 'progress_amount',
+                'pending_quantity']
+        if workers is None:
+            workers = config.getint('project_product', 'metrics_workers',
+                default=2)
+        table = cls.__table__()
+        cursor = transaction.connection.cursor()
+
+        company2ids = defaultdict(list)
+        for sub_ids in grouped_slice([w.id for w in works]):
+            cursor.execute(*table.select(table.company, table.id,
+                    where=reduce_ids(table.id, sub_ids)))
+            for company_id, work_id in cursor.fetchall():
+                company2ids[company_id].append(work_id)
+
+        result = dict((name, {}) for name in names)
+        if not company2ids:
+            return result
+
+        database_name = transaction.database.name
+        user = transaction.user
+        context = transaction.context.copy()
+
+        def compute(item):
+            company_id, ids = item
+            return cls._get_company_goods_metrics(database_name, user,
+                dict(context, company=company_id), ids, names)
+
+        threads = ThreadPool(min(workers, len(company2ids)))
+        try:
+            for values in threads.imap_unordered(compute,
+                    company2ids.iteritems()):
+                for value in values:
+                    for name in names:
+                        result[name][value['id']] = value[name]
+        finally:
+            threads.close()
+            threads.join()
+        return result
+
+    @classmethod
+    def _get_company_goods_metrics(cls, database_name, user, context, ids,
+            names):
+        "Read names of the works of a company in a new transaction"
+        with Transaction(new=True).start(database_name, user, readonly=True,
+                context=context):
+            return cls.read(ids, names)
+
     @classmethod
     def _get_progress_amount(cls, works):
         digits = cls.progress_amount.digits[1]
@@ -283,10 +423,6 @@ class Work:
             else:
                 amount = Decimal(0)
             result[work.id] = amount.quantize(Decimal(str(10 ** - digits)))
-
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.info(result)
         return result
 
     @classmethod
@@ -317,18 +453,12 @@ class Work:
     @classmethod
     def _get_invoice_values(cls, works, name):
         if name in ('invoiced_duration', 'duration_to_invoice'):
-            service_works = []
-            res = {}
             default_value = getattr(cls, 'default_%s' % name)()
-            for work in works:
-                if work.invoice_product_type == 'goods':
-                    res[work.id] = default_value
-                else:
-                    service_works.append(work)
-            if service_works:
-                res.update(
-                    super(Work, cls)._get_invoice_values(service_works, name))
-            return res
+            return get_service_goods_aux(
+                works,
+                lambda works: super(Work, cls)._get_invoice_values(
+                    works, name),
+                lambda work: default_value)
         # name == invoiced_amount
         # it will call _get_invoiced_amount_{manual,effort,progress,timesheet}
         return super(Work, cls)._get_invoice_values(works, name)
@@ -407,6 +537,55 @@ class Work:
             super(Work, cls)._get_invoiced_amount_timesheet(service_works))
         return amounts
 
+    @classmethod
+    @ModelView.button
+    def invoice(cls, works):
+        pool = Pool()
+        Config = pool.get('work.configuration')
+        Profile = pool.get('project.work.invoice_profile')
+
+        context = Transaction().context
+        if get_invoice_profiler():
+            return super(Work, cls).invoice(works)
+        if not works or not (context.get('invoice_profile')
+                or Config(1).invoice_profile):
+            # Only the lines and records of a chunk of works are kept in
+            # memory, each invoice still gets all the lines of its work
+            for chunk in iter_chunks(works):
+                super(Work, cls).invoice(chunk)
+            return
+
+        # One profile per company so each is visible under its company rule
+        profiles = []
+        works = sorted(works, key=lambda w: w.company.id)
+        for company, company_works in groupby(works, key=lambda w: w.company):
+            company_works = list(company_works)
+            profiler = InvoiceProfiler()
+            with Transaction().set_context(_invoice_profiler=profiler):
+                start = time.time()
+                for chunk in iter_chunks(company_works):
+                    super(Work, cls).invoice(chunk)
+                profiler.duration = time.time() - start
+            profiles.append(
+                profiler.get_profile_values(company, company_works))
+        with Transaction().set_context(_check_access=False):
+            Profile.create(profiles)
+
+    @classmethod
+    def write(cls, *args):
+        if not get_invoice_profiler():
+            return super(Work, cls).write(*args)
+        actions = iter(args)
+        rows = sum(len(works) for works, _ in zip(actions, actions))
+        with profile_invoice_stage('save') as count:
+            super(Work, cls).write(*args)
+            count(rows)
+
+    def _get_lines_to_invoice(self, test=None):
+        with profile_invoice_stage('lines') as count:
+            lines = super(Work, self)._get_lines_to_invoice(test=test)
+            count(len(lines))
+        return lines
 
     def _get_lines_to_invoice_effort(self):
         pool = Pool()
@@ -444,7 +623,7 @@ class Work:
         if self.progress_quantity is None:
             return []
 
-        quantity = self.progress_quantity - self.invoiced_quantity
+        quantity = self.pending_quantity
         if quantity > 0:
             if not self.product_goods:
                 self.raise_user_error('missing_product', (self.rec_name,))
@@ -472,11 +651,18 @@ class Work:
         ModelData = pool.get('ir.model.data')
         Uom = pool.get('product.uom')
 
-        res = super(Work, self)._group_lines_to_invoice_key(line)
-        # use hour as unit for service works
-        hour = Uom(ModelData.get_id('product', 'uom_hour'))
-        return res + (('unit', line.get('unit', hour)),)
-
+        with profile_invoice_stage('grouping'):
+            res = super(Work, self)._group_lines_to_invoice_key(line)
+            # use hour as unit for service works
+            hour = Uom(ModelData.get_id('product', 'uom_hour'))
+            res += (('unit', line.get('unit', hour)),)
+        profiler = get_invoice_profiler()
+        if profiler:
+            # project_invoice groups the lines of each work with groupby
+            profiler.add_group_key((self.id, res))
+        return res
+
+    @profile_invoice_call('invoice_line')
     def _get_invoice_line(self, key, invoice, lines):
         "Return a invoice line for the lines"
         pool = Pool()
@@ -506,6 +692,13 @@ class Work:
         invoice_line.unit_price = Uom.compute_price(
             unit, key['unit_price'], product.default_uom)
 
+        invoice_line.taxes = self._get_invoice_line_taxes(invoice_line,
+            invoice, product)
+        return invoice_line
+
+    @profile_invoice_call('taxes')
+    def _get_invoice_line_taxes(self, invoice_line, invoice, product):
+        "Return the tax ids of the goods invoice line"
         taxes = []
         pattern = invoice_line._get_tax_rule_pattern()
         party = invoice.party
@@ -520,5 +713,4 @@ class Work:
             tax_ids = party.customer_tax_rule.apply(None, pattern)
             if tax_ids:
                 taxes.extend(tax_ids)
-        invoice_line.taxes = taxes
-        return invoice_line
+        return taxes